@@ -2,12 +2,14 @@
 from tgtg import TgtgClient
 from telegram import Bot
 from telegram.ext import Application
-import json
-from datetime import datetime, timedelta
+import orjson
+from datetime import datetime
 import os
-import pytz
+import re
+import time
+from zoneinfo import ZoneInfo
 import asyncio
-from typing import Optional
+from typing import Optional, Tuple
 import logging
 import sys
 
@@ -52,77 +54,108 @@ def get_tgtg_client(email: Optional[str] = None, access_token: Optional[str] = N
         raise TGTGError(f"TGTG client initialization failed: {str(e)}")
 
 # Alert history management
-ALERT_HISTORY_FILE = "alert_history.json"
+# The history is an append-only JSON Lines log: one {"id": ..., "ts": ...} record
+# per alert, with ts in epoch seconds. On load, later records for the same item
+# override earlier ones.
+ALERT_HISTORY_FILE = "alert_history.jsonl"
+# Previous releases stored a single {item_id: iso_timestamp} JSON dict
+LEGACY_ALERT_HISTORY_FILE = "alert_history.json"
+ALERT_COOLDOWN = 2 * 60 * 60  # seconds
 
 def load_alert_history():
+    history = {}
+    if os.path.exists(LEGACY_ALERT_HISTORY_FILE):
+        try:
+            with open(LEGACY_ALERT_HISTORY_FILE, 'rb') as f:
+                # Convert the legacy ISO-8601 timestamps to epoch seconds
+                for item_id, ts in orjson.loads(f.read()).items():
+                    history[item_id] = datetime.fromisoformat(ts).timestamp()
+        except (orjson.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+            logger.error(f"Error reading legacy alert history file: {str(e)}")
+            raise TGTGError(f"Failed to read alert history: {str(e)}")
     if os.path.exists(ALERT_HISTORY_FILE):
         try:
-            with open(ALERT_HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError as e:
+            with open(ALERT_HISTORY_FILE, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        record = orjson.loads(line)
+                        history[record['id']] = record['ts']
+        except (orjson.JSONDecodeError, KeyError, TypeError) as e:
             logger.error(f"Error reading alert history file: {str(e)}")
             raise TGTGError(f"Failed to read alert history: {str(e)}")
-    return {}
+    return history
 
 def save_alert_history(history):
+    """Rewrite the history log with a single record per item."""
+    try:
+        with open(ALERT_HISTORY_FILE, 'wb') as f:
+            for item_id, ts in history.items():
+                f.write(orjson.dumps({"id": item_id, "ts": ts}) + b"\n")
+    except Exception as e:
+        logger.error(f"Error saving alert history: {str(e)}")
+        raise TGTGError(f"Failed to save alert history: {str(e)}")
+
+def record_alert(history_file, item_id, ts):
+    """Append a single alert record to an open history log."""
     try:
-        with open(ALERT_HISTORY_FILE, 'w') as f:
-            json.dump(history, f)
+        history_file.write(orjson.dumps({"id": item_id, "ts": ts}) + b"\n")
     except Exception as e:
         logger.error(f"Error saving alert history: {str(e)}")
         raise TGTGError(f"Failed to save alert history: {str(e)}")
 
+def prune_alert_history(history):
+    """Drop items whose last alert is older than the cooldown, as they can no longer block an alert."""
+    current_time = time.time()
+    return {
+        item_id: ts for item_id, ts in history.items()
+        if (current_time - ts) < ALERT_COOLDOWN
+    }
+
 def can_send_alert(item_id, history):
     if item_id not in history:
         return True
     
-    last_alert_time = datetime.fromisoformat(history[item_id])
-    current_time = datetime.now()
-    
-    return (current_time - last_alert_time) >= timedelta(hours=2)
+    return (time.time() - history[item_id]) >= ALERT_COOLDOWN
 
-async def send_messages(bot, chat_id, text_message, latitude, longitude):
+async def send_messages(bot, chat_id, title, address, latitude, longitude):
     try:
-        await bot.send_message(chat_id=chat_id, text=text_message)
-        await bot.send_location(chat_id=chat_id, latitude=latitude, longitude=longitude)
+        # A venue carries the shop name, pickup time and map pin in a single request
+        await bot.send_venue(chat_id=chat_id, latitude=latitude, longitude=longitude,
+                             title=title, address=address)
         logger.info(f"Successfully sent notification for location: {latitude}, {longitude}")
     except Exception as e:
         logger.error(f"Failed to send Telegram message: {str(e)}")
         raise TGTGError(f"Failed to send Telegram message: {str(e)}")
 
-async def run_bot(messages, chat_id, api_key):
+async def run_bot(display_name: str, pickup_time: str, location: Optional[Tuple[float, float]],
+                  chat_id, bot):
     try:
-        message_text = []
-        stored_location = None
-       
-        for line in messages:
-            if line.startswith("Location:"):
-                coordinates = line.replace("Location: ", "").split(",")
-                lat, lng = float(coordinates[0]), float(coordinates[1])
-                stored_location = (lat, lng)
-            else:
-                message_text.append(line)
-       
-        message_text = "\n".join(message_text)
-       
-        application = Application.builder().token(api_key).build()
-        async with application:
-            if stored_location:
-                await send_messages(
-                    application.bot,
-                    chat_id,
-                    message_text,
-                    stored_location[0],
-                    stored_location[1]
-                )
+        if location:
+            await send_messages(bot, chat_id, display_name, pickup_time, location[0], location[1])
+        else:
+            # Without coordinates there is no venue to send, so alert with plain text
+            logger.warning(f"No coordinates for {display_name}, sending alert without a map pin")
+            await bot.send_message(chat_id=chat_id,
+                                   text=f"Shop: {display_name}\nPickup time: {pickup_time}")
     except Exception as e:
         logger.error(f"Error in run_bot: {str(e)}")
         raise TGTGError(f"Bot execution failed: {str(e)}")
 
+_AUTH_ERROR_RE = re.compile(r'401|unauthorized|auth|token', re.IGNORECASE)
+
 def check_auth_error(error_str: str) -> bool:
     """Check if error string indicates an authentication error"""
-    auth_error_indicators = ['401', 'UNAUTHORIZED', 'auth', 'token']
-    return any(indicator.lower() in error_str.lower() for indicator in auth_error_indicators)
+    return bool(_AUTH_ERROR_RE.search(error_str))
+
+def fetch_favorites(tgtg_client: TgtgClient):
+    """Fetch favorites from TGTG, mapping failures to TGTG bot errors."""
+    try:
+        return tgtg_client.get_favorites()
+    except Exception as e:
+        error_str = str(e)
+        if check_auth_error(error_str):
+            raise TGTGAuthError("TGTG authentication failed - invalid or expired tokens")
+        raise TGTGError(f"Failed to fetch favorites: {error_str}")
 
 async def async_main() -> int:
     try:
@@ -136,65 +169,109 @@ async def async_main() -> int:
         if not chat_id or not api_key:
             raise TGTGError("Missing required environment variables: TELEGRAM_CHAT_ID or TELEGRAM_API_KEY")
 
-        # Load alert history
-        alert_history = load_alert_history()
+        # Fetch favorites from TGTG while the alert history loads from disk
+        logger.info("Fetching favorites from TGTG")
+        favorites, alert_history = await asyncio.gather(
+            asyncio.to_thread(fetch_favorites, tgtg_client),
+            asyncio.to_thread(load_alert_history)
+        )
         logger.info("Alert history loaded successfully")
 
+        # Compact the history log down to items still within the cooldown
+        pruned_history = prune_alert_history(alert_history)
+        migrating = os.path.exists(LEGACY_ALERT_HISTORY_FILE)
+        expired = len(alert_history) - len(pruned_history)
+        if migrating or expired:
+            if expired:
+                logger.info(f"Pruning {expired} expired alert history entries")
+            save_alert_history(pruned_history)
+        alert_history = pruned_history
+
+        # The legacy history is now part of the log and can go
+        if migrating:
+            try:
+                os.remove(LEGACY_ALERT_HISTORY_FILE)
+                logger.info(f"Migrated {LEGACY_ALERT_HISTORY_FILE} to {ALERT_HISTORY_FILE}")
+            except OSError as e:
+                logger.warning(f"Could not remove legacy alert history file: {str(e)}")
+
         # Set up timezone
-        utc = pytz.utc
-        mdt = pytz.timezone('America/Edmonton')
-        
-        # Get favorites from TGTG
-        logger.info("Fetching favorites from TGTG")
-        try:
-            favorites = tgtg_client.get_favorites()
-        except Exception as e:
-            error_str = str(e)
-            if check_auth_error(error_str):
-                raise TGTGAuthError("TGTG authentication failed - invalid or expired tokens")
-            raise TGTGError(f"Failed to fetch favorites: {error_str}")
+        mdt = ZoneInfo('America/Edmonton')
 
         logger.info(f"Found {len(favorites)} favorite items")
 
-        messages = []
+        # Building the Application is local; Telegram is only contacted once it is entered
+        application = Application.builder().token(api_key).build()
+        alert_ids = []
+        tasks = []
+        bad_entries = 0
         for entry in favorites:
+            display_name = None
             try:
-                items_available = entry.get('items_available')
+                # Most favorites are sold out, so check availability before anything else
+                if not entry.get('items_available'):
+                    continue
                 item_id = entry['item'].get('item_id')
+                if not can_send_alert(item_id, alert_history):
+                    continue
+
                 display_name = entry.get('display_name')
                 pickup_interval = entry.get('pickup_interval')
                 pickup_location = entry.get('pickup_location')
+                logger.info(f"Found available items for {display_name} (ID: {item_id})")
+            
+                location = None
+                if pickup_location and 'location' in pickup_location:
+                    coordinates = pickup_location['location']
+                    latitude = coordinates.get('latitude')
+                    longitude = coordinates.get('longitude')
+                    if latitude is not None and longitude is not None:
+                        location = (latitude, longitude)
+            
+                if pickup_interval and 'start' in pickup_interval and 'end' in pickup_interval:
+                    start_utc = datetime.fromisoformat(pickup_interval['start'].replace('Z', '+00:00'))
+                    end_utc = datetime.fromisoformat(pickup_interval['end'].replace('Z', '+00:00'))
+                    start_mdt = start_utc.astimezone(mdt)
+                    end_mdt = end_utc.astimezone(mdt)
+                    readable_start = start_mdt.strftime("%Y-%m-%d %I:%M %p %Z")
+                    readable_end = end_mdt.strftime("%Y-%m-%d %I:%M %p %Z")
+            
+                    pickup_time = readable_start + "/" + readable_end
                 
-                if items_available > 0 and can_send_alert(item_id, alert_history):
-                    logger.info(f"Found available items for {display_name} (ID: {item_id})")
-                    
-                    if pickup_location and 'location' in pickup_location:
-                        location = pickup_location['location']
-                    
-                    if pickup_interval and 'start' in pickup_interval and 'end' in pickup_interval:
-                        start_utc = datetime.strptime(pickup_interval['start'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=utc)
-                        end_utc = datetime.strptime(pickup_interval['end'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=utc)
-                        start_mdt = start_utc.astimezone(mdt)
-                        end_mdt = end_utc.astimezone(mdt)
-                        readable_start = start_mdt.strftime("%Y-%m-%d %I:%M %p %Z")
-                        readable_end = end_mdt.strftime("%Y-%m-%d %I:%M %p %Z")
-                    
-                        messages = [
-                            "",
-                            "Shop: " + display_name,
-                            "Pickup time: " + readable_start + "/" + readable_end,
-                            "Location: " + str(location.get('latitude')) + "," + str(location.get('longitude'))
-                        ]
-                        
-                        await run_bot(messages, chat_id, api_key)
-                        
-                        alert_history[item_id] = datetime.now().isoformat()
-                        save_alert_history(alert_history)
-                        
-                        messages = []
+                    alert_ids.append(item_id)
+                    tasks.append(run_bot(display_name, pickup_time, location, chat_id, application.bot))
             except Exception as e:
+                # Don't let one malformed favorite block the other alerts
+                bad_entries += 1
                 logger.error(f"Error processing entry for {display_name}: {str(e)}")
-                raise TGTGError(f"Error processing entry: {str(e)}")
+                continue
+
+        # Send all alerts concurrently, then record the ones that went through.
+        # Runs with nothing to send never contact Telegram.
+        results = []
+        if tasks:
+            async with application:
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        sent_ids = []
+        for item_id, result in zip(alert_ids, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Error sending alert for item {item_id}: {str(result)}")
+                continue
+            alert_history[item_id] = time.time()
+            sent_ids.append(item_id)
+
+        # Only touch the history log when this run actually sent alerts
+        if sent_ids:
+            with open(ALERT_HISTORY_FILE, 'ab') as history_file:
+                for item_id in sent_ids:
+                    record_alert(history_file, item_id, alert_history[item_id])
+
+        failures = len(alert_ids) - len(sent_ids)
+        if failures:
+            raise TGTGError(f"Failed to send {failures} of {len(tasks)} alerts")
+        if bad_entries:
+            raise TGTGError(f"Failed to process {bad_entries} favorite entries")
 
         return 0
 